@@ -20,7 +20,10 @@
 # LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
-from threading import Lock
+import struct
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock, get_ident
 
 import spidev
 
@@ -28,17 +31,40 @@ from RPiMCP23S17.errors import NotInitialized
 from RPiMCP23S17.virtual_pin import VirtualPin
 from gpio import Pin
 
+try:
+    from RPiMCP23S17._mcp_fast import FastMCP
+except ImportError:
+    FastMCP = None
+
+try:
+    import micropython
+except ImportError:
+    class micropython(object):
+        """Stand-in for CPython, where @micropython.native is a no-op."""
+
+        @staticmethod
+        def native(f):
+            return f
 
-def lock(f):
-    def wrapper(self, *args, **kwargs):
-        if not self.isInitialized:
-            raise NotInitialized(f"{self.__class__.__name__} not initialized. "
-                                 f"Please call open() or use the context manager")
-        with self.lock:
-            res = f(self, *args, **kwargs)
-        return res
 
-    return wrapper
+# Offsets of the A/B register pairs in MCP23S17._mirror
+_OFF_GPIO = 0
+_OFF_IODIR = 2
+_OFF_GPPU = 4
+
+
+@micropython.native
+def _prep_bit(mirror, offset, pin, value):
+    """Computes the register value needed to set or clear the bit of a pin.
+
+    Returns a tuple (data, index) where index is the position of the pin's
+    register in mirror.
+    """
+    index = offset + (pin >> 3)
+    mask = 1 << (pin & 0x07)
+    data = mirror[index]
+    data = (data | mask) if value else (data & ~mask)
+    return data, index
 
 
 class MCP23S17(object):
@@ -90,6 +116,12 @@ class MCP23S17(object):
     MCP23S17_CMD_WRITE = 0x40
     MCP23S17_CMD_READ = 0x41
 
+    """Register address of each pin index, for per-pin register access
+    """
+    _DIR_REG = (MCP23S17_IODIRA,) * 8 + (MCP23S17_IODIRB,) * 8
+    _GPIO_REG = (MCP23S17_GPIOA,) * 8 + (MCP23S17_GPIOB,) * 8
+    _PU_REG = (MCP23S17_GPPUA,) * 8 + (MCP23S17_GPPUB,) * 8
+
     def __init__(self, spi: spidev.SpiDev,
                  reset_pin: Pin = None,
                  intA_pin: Pin = None,
@@ -107,17 +139,17 @@ class MCP23S17(object):
         pin_reset -- The Reset pin of the MCP
         """
         self.device_id = device_id
-        self._GPIOA = 0
-        self._GPIOB = 0
-        self._IODIRA = 0
-        self._IODIRB = 0
-        self._GPPUA = 0
-        self._GPPUB = 0
+        self._mirror = bytearray(6)
+        self._batch_snapshot = None
+        self._batch_owner = None
+        self._batch_nested = []
         self.reset_pin = reset_pin
         self.int_pins = [intA_pin, intB_bin]
         self.int_level = int_level
-        self.lock = lock
+        self.lock = lock if lock is not None else Lock()
         self._spi = spi
+        self._spimode = 0
+        self._current_mode = None
         self.isInitialized = False
 
     def open(self):
@@ -127,18 +159,51 @@ class MCP23S17(object):
         self._setupGPIO()
         # TODO: check spi is opened
         # self._spi.open(self._bus, self._pin_cs)
+        self._cmd_write = MCP23S17.MCP23S17_CMD_WRITE | (self.device_id << 1)
+        self._cmd_read = MCP23S17.MCP23S17_CMD_READ | (self.device_id << 1)
+        # write-only transfers do not need the received bytes: writebytes2
+        # (spidev >= 3.4) takes the buffer as is and returns nothing
+        spi_write = getattr(self._spi, "writebytes2", None)
+        self._spi_write = spi_write if spi_write is not None else self._spi.writebytes
+        # reusable transfer buffers with the command byte already in place
+        self._tx3_write = bytearray((self._cmd_write, 0, 0))
+        self._tx3_read = bytearray((self._cmd_read, 0, 0))
+        self._tx4_write = bytearray((self._cmd_write, 0, 0, 0))
+        self._tx4_read = bytearray((self._cmd_read, 0, 0, 0))
+        # per-pin (transfer buffer, bit mask, mirror index) for digitalWrite
+        self._pin_plan = tuple(
+            (bytearray((self._cmd_write, MCP23S17._GPIO_REG[pin], 0)),
+             1 << (pin & 0x07),
+             _OFF_GPIO + (pin >> 3))
+            for pin in range(MCP23S17.N_PINS))
+        # C fast path for digitalWrite, if the extension was built; only for
+        # an actual spidev.SpiDev, since it bypasses the object entirely
+        self._fast_write = None
+        if FastMCP is not None and isinstance(self._spi, spidev.SpiDev):
+            fd = self._spi.fileno()
+            if isinstance(fd, int) and fd >= 0:
+                self._fast_write = FastMCP(fd, self._cmd_write, self._mirror, _OFF_GPIO).digital_write
+        # the lock methods are bound once, every method uses the same lock
+        self._lock_acquire = self.lock.acquire
+        self._lock_release = self.lock.release
         self.isInitialized = True
-        self._writeRegister(MCP23S17.MCP23S17_IOCON, MCP23S17.IOCON_INIT)
-
-        # set defaults
-        for index in range(0, 15):
-            self.setDirection(index, MCP23S17.DIR_INPUT)
-            self.setPullupMode(index, MCP23S17.PULLUP_ENABLED)
+        self._lock_acquire()
+        try:
+            self._setSpiMode(self._spimode)
+            self._writeRegister(MCP23S17.MCP23S17_IOCON, MCP23S17.IOCON_INIT)
+
+            # set defaults: all pins are inputs with pull-ups enabled
+            self._writeRegisterWord(MCP23S17.MCP23S17_IODIRA, 0xFFFF)
+            self._writeRegisterWord(MCP23S17.MCP23S17_GPPUA, 0xFFFF)
+        finally:
+            self._lock_release()
+        struct.pack_into("<HH", self._mirror, _OFF_IODIR, 0xFFFF, 0xFFFF)
 
     def close(self):
         """Closes the SPI connection that the MCP23S17 component is using.
         """
         self._spi.close()
+        self._current_mode = None
         self.isInitialized = False
 
     def __enter__(self):
@@ -156,30 +221,21 @@ class MCP23S17(object):
         mode -- The pull-up mode (MCP23S17.PULLUP_ENABLED, MCP23S17.PULLUP_DISABLED)
         """
 
-        assert pin < 16
-        assert (mode == MCP23S17.PULLUP_ENABLED) or (mode == MCP23S17.PULLUP_DISABLED)
-        assert self.isInitialized
-
-        if pin < 8:
-            register = MCP23S17.MCP23S17_GPPUA
-            data = self._GPPUA
-            noshifts = pin
-        else:
-            register = MCP23S17.MCP23S17_GPPUB
-            noshifts = pin & 0x07
-            data = self._GPPUB
-
-        if mode == MCP23S17.PULLUP_ENABLED:
-            data |= (1 << noshifts)
-        else:
-            data &= (~(1 << noshifts))
-
-        self._writeRegister(register, data)
-
-        if pin < 8:
-            self._GPPUA = data
-        else:
-            self._GPPUB = data
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        if not 0 <= pin < MCP23S17.N_PINS:
+            raise IndexError("pin index out of range")
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            mirror = self._mirror
+            data, index = _prep_bit(mirror, _OFF_GPPU, pin, mode == MCP23S17.PULLUP_ENABLED)
+            self._writeRegister(MCP23S17._PU_REG[pin], data)
+            mirror[index] = data
+        finally:
+            if not batch_owner:
+                self._lock_release()
 
     def setDirection(self, pin, direction):
         """Sets the direction for a given pin.
@@ -189,89 +245,150 @@ class MCP23S17(object):
         direction -- The direction of the pin (MCP23S17.DIR_INPUT, MCP23S17.DIR_OUTPUT)
         """
 
-        assert (pin < 16)
-        assert ((direction == MCP23S17.DIR_INPUT) or (direction == MCP23S17.DIR_OUTPUT))
-        assert self.isInitialized
-
-        if pin < 8:
-            register = MCP23S17.MCP23S17_IODIRA
-            data = self._IODIRA
-            noshifts = pin
-        else:
-            register = MCP23S17.MCP23S17_IODIRB
-            noshifts = pin & 0x07
-            data = self._IODIRB
-
-        if direction == MCP23S17.DIR_INPUT:
-            data |= (1 << noshifts)
-        else:
-            data &= (~(1 << noshifts))
-
-        self._writeRegister(register, data)
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        if not 0 <= pin < MCP23S17.N_PINS:
+            raise IndexError("pin index out of range")
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            mirror = self._mirror
+            data, index = _prep_bit(mirror, _OFF_IODIR, pin, direction == MCP23S17.DIR_INPUT)
+            self._writeRegister(MCP23S17._DIR_REG[pin], data)
+            mirror[index] = data
+        finally:
+            if not batch_owner:
+                self._lock_release()
+
+    def setDirections16(self, mask):
+        """Sets the direction of all pins at once.
+        Parameters:
+        mask - The 16-bit IODIR value, a set bit configures the pin as input.
+        """
 
-        if (pin < 8):
-            self._IODIRA = data
-        else:
-            self._IODIRB = data
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            struct.pack_into("<H", self._mirror, _OFF_IODIR, mask & 0xFFFF)
+            self._writeRegisterWord(MCP23S17.MCP23S17_IODIRA, mask)
+        finally:
+            if not batch_owner:
+                self._lock_release()
+
+    def setPullups16(self, mask):
+        """Sets the pull-up mode of all pins at once.
+        Parameters:
+        mask - The 16-bit GPPU value, a set bit enables the pull-up of the pin.
+        """
 
-    def digitalRead(self, pin):
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            struct.pack_into("<H", self._mirror, _OFF_GPPU, mask & 0xFFFF)
+            self._writeRegisterWord(MCP23S17.MCP23S17_GPPUA, mask)
+        finally:
+            if not batch_owner:
+                self._lock_release()
+
+    def digitalRead(self, pin, refresh=True):
         """Reads the logical level of a given pin.
 
         Parameters:
         pin -- The pin index (0 - 15)
+        refresh -- Read the pin's port from the chip (default True). If False,
+                   the level last fetched, e.g. by refreshInputs(), is returned.
         Returns:
          - MCP23S17.LEVEL_LOW, if the logical level of the pin is low,
          - MCP23S17.LEVEL_HIGH, otherwise.
         """
 
-        assert self.isInitialized
-        assert (pin < 16)
-
-        if pin < 8:
-            self._GPIOA = self._readRegister(MCP23S17.MCP23S17_GPIOA)
-            if (self._GPIOA & (1 << pin)) != 0:
-                return MCP23S17.LEVEL_HIGH
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        if not 0 <= pin < MCP23S17.N_PINS:
+            raise IndexError("pin index out of range")
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            index = _OFF_GPIO + (pin >> 3)
+            if refresh:
+                data = self._readRegister(MCP23S17._GPIO_REG[pin])
+                if self._batch_snapshot is None:
+                    self._mirror[index] = data
+                else:
+                    self._mergeRead(index, data)
             else:
-                return MCP23S17.LEVEL_LOW
-        else:
-            self._GPIOB = self._readRegister(MCP23S17.MCP23S17_GPIOB)
-            pin &= 0x07
-            if (self._GPIOB & (1 << pin)) != 0:
-                return MCP23S17.LEVEL_HIGH
+                data = self._mirror[index]
+            return (data >> (pin & 0x07)) & 0x01
+        finally:
+            if not batch_owner:
+                self._lock_release()
+
+    def refreshInputs(self):
+        """Reads the levels of all pins with a single transfer, to be
+        queried afterwards with digitalRead(pin, refresh=False).
+        """
+
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            data = self._readRegisterWord(MCP23S17.MCP23S17_GPIOA)
+            if self._batch_snapshot is None:
+                struct.pack_into("<H", self._mirror, _OFF_GPIO, data & 0xFFFF)
             else:
-                return MCP23S17.LEVEL_LOW
+                self._mergeRead(_OFF_GPIO, data & 0xFF)
+                self._mergeRead(_OFF_GPIO + 1, (data >> 8) & 0xFF)
+        finally:
+            if not batch_owner:
+                self._lock_release()
 
     def digitalWrite(self, pin, level):
         """Sets the level of a given pin.
+        When the optional C extension is built and spi is a spidev.SpiDev,
+        the transfer is issued directly on its file descriptor, without
+        going through the SpiDev object.
         Parameters:
         pin -- The pin index (0 - 15)
         level -- The logical level to be set (LEVEL_LOW, LEVEL_HIGH)
         """
 
-        assert self.isInitialized
-        assert (pin < 16)
-        assert (level == MCP23S17.LEVEL_HIGH) or (level == MCP23S17.LEVEL_LOW)
-
-        if pin < 8:
-            register = MCP23S17.MCP23S17_GPIOA
-            data = self._GPIOA
-            noshifts = pin
-        else:
-            register = MCP23S17.MCP23S17_GPIOB
-            noshifts = pin & 0x07
-            data = self._GPIOB
-
-        if level == MCP23S17.LEVEL_HIGH:
-            data |= (1 << noshifts)
-        else:
-            data &= (~(1 << noshifts))
-
-        self._writeRegister(register, data)
-
-        if (pin < 8):
-            self._GPIOA = data
-        else:
-            self._GPIOB = data
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        if not 0 <= pin < MCP23S17.N_PINS:
+            raise IndexError("pin index out of range")
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            if self._batch_snapshot is not None:
+                _, mask, index = self._pin_plan[pin]
+                mirror = self._mirror
+                data = mirror[index]
+                mirror[index] = (data | mask) if level == MCP23S17.LEVEL_HIGH else (data & ~mask)
+                return
+            if self._fast_write is not None:
+                self._fast_write(pin, level == MCP23S17.LEVEL_HIGH)
+                return
+            buf, mask, index = self._pin_plan[pin]
+            mirror = self._mirror
+            data = mirror[index]
+            data = (data | mask) if level == MCP23S17.LEVEL_HIGH else (data & ~mask)
+            buf[2] = data
+            self._spi_write(buf)
+            mirror[index] = data
+        finally:
+            if not batch_owner:
+                self._lock_release()
 
     def writeGPIO(self, data):
         """Sets the data port value for all pins.
@@ -279,11 +396,17 @@ class MCP23S17(object):
         data - The 16-bit value to be set.
         """
 
-        assert self.isInitialized
-
-        self._GPIOA = (data & 0xFF)
-        self._GPIOB = (data >> 8)
-        self._writeRegisterWord(MCP23S17.MCP23S17_GPIOA, data)
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            struct.pack_into("<H", self._mirror, _OFF_GPIO, data & 0xFFFF)
+            self._writeRegisterWord(MCP23S17.MCP23S17_GPIOA, data)
+        finally:
+            if not batch_owner:
+                self._lock_release()
 
     def readGPIO(self):
         """Reads the data port value of all pins.
@@ -291,39 +414,147 @@ class MCP23S17(object):
          - The 16-bit data port value
         """
 
-        assert self.isInitialized
-        data = self._readRegisterWord(MCP23S17.MCP23S17_GPIOA)
-        self._GPIOA = (data & 0xFF)
-        self._GPIOB = (data >> 8)
-        return data
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        batch_owner = self._batch_owner == get_ident()
+        if not batch_owner:
+            self._lock_acquire()
+        try:
+            data = self._readRegisterWord(MCP23S17.MCP23S17_GPIOA)
+            if self._batch_snapshot is None:
+                struct.pack_into("<H", self._mirror, _OFF_GPIO, data & 0xFFFF)
+            else:
+                self._mergeRead(_OFF_GPIO, data & 0xFF)
+                self._mergeRead(_OFF_GPIO + 1, (data >> 8) & 0xFF)
+            return data
+        finally:
+            if not batch_owner:
+                self._lock_release()
+
+    @contextmanager
+    def batch(self):
+        """Context manager deferring register writes until it exits.
+        Within the block, setDirection, setPullupMode, digitalWrite and the
+        16-bit variants only update the register mirror. On exit, each
+        changed register pair is written with a single transfer. If the block
+        raises, the writes deferred within it are discarded; for a nested
+        block, the writes of the enclosing blocks are kept.
+        The lock is held for the whole block: calls from other threads wait
+        until the changes are written.
+        Reads are not deferred. They return the levels on the chip, but do
+        not replace a GPIO mirror byte that holds pending writes, so a later
+        digitalRead(pin, refresh=False) on that port returns the pending
+        value.
+
+        Example:
+        with mcp.batch():
+            for pin in range(0, 16):
+                mcp.setDirection(pin, MCP23S17.DIR_OUTPUT)
+                mcp.digitalWrite(pin, MCP23S17.LEVEL_LOW)
+        """
+
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        ident = get_ident()
+        if self._batch_owner == ident:
+            # nested batch, the outermost one writes the changes but the
+            # nested block still rolls back its own writes on error
+            snapshot = bytearray(self._mirror)
+            self._batch_nested.append(snapshot)
+            try:
+                yield self
+            except BaseException:
+                self._mirror[:] = snapshot
+                raise
+            finally:
+                self._batch_nested.pop()
+            return
+        self._lock_acquire()
+        try:
+            self._batch_owner = ident
+            self._batch_snapshot = bytearray(self._mirror)
+            try:
+                yield self
+            except BaseException:
+                # discard the deferred writes, the mirror goes back to the
+                # state of the chip
+                self._mirror[:] = self._batch_snapshot
+                raise
+            finally:
+                snapshot, self._batch_snapshot = self._batch_snapshot, None
+            self._flush(snapshot)
+        finally:
+            self._batch_owner = None
+            self._lock_release()
 
     def setInterrupt(self, pin, mode):
         raise NotImplementedError("TODO")
 
-    @lock
+    def _notInitializedError(self):
+        return NotInitialized(f"{self.__class__.__name__} not initialized. "
+                              f"Please call open() or use the context manager")
+
+    def _mergeRead(self, index, data):
+        # a read during a batch only refreshes mirror bytes without pending
+        # writes, and moves the snapshots along so they are not flushed
+        mirror = self._mirror
+        current = mirror[index]
+        if current == self._batch_snapshot[index]:
+            self._batch_snapshot[index] = data
+            for snapshot in self._batch_nested:
+                if snapshot[index] == current:
+                    snapshot[index] = data
+            mirror[index] = data
+
+    def _flush(self, snapshot):
+        # called by batch() with the lock held
+        if not self.isInitialized:
+            raise self._notInitializedError()
+        mirror = self._mirror
+        # output latches are written before directions, so that pins
+        # switched to output start with their new level
+        for offset, register in ((_OFF_GPPU, MCP23S17.MCP23S17_GPPUA),
+                                 (_OFF_GPIO, MCP23S17.MCP23S17_GPIOA),
+                                 (_OFF_IODIR, MCP23S17.MCP23S17_IODIRA)):
+            changed_a = mirror[offset] != snapshot[offset]
+            changed_b = mirror[offset + 1] != snapshot[offset + 1]
+            if changed_a and changed_b:
+                self._writeRegisterWord(register, mirror[offset] | (mirror[offset + 1] << 8))
+            elif changed_a:
+                self._writeRegister(register, mirror[offset])
+            elif changed_b:
+                self._writeRegister(register + 1, mirror[offset + 1])
+
     def _writeRegister(self, register, value):
-        command = MCP23S17.MCP23S17_CMD_WRITE | (self.device_id << 1)
-        self._setSpiMode(self._spimode)
-        self._spi.xfer2([command, register, value])
+        if self._batch_snapshot is not None:
+            return
+        buf = self._tx3_write
+        buf[1] = register
+        buf[2] = value
+        self._spi_write(buf)
 
-    @lock
     def _readRegister(self, register):
-        command = MCP23S17.MCP23S17_CMD_READ | (self.device_id << 1)
-        self._setSpiMode(self._spimode)
-        data = self._spi.xfer2([command, register, 0])
+        buf = self._tx3_read
+        buf[1] = register
+        data = self._spi.xfer2(buf)
         return data[2]
 
     def _readRegisterWord(self, register):
-        assert self.isInitialized
-        buffer = [0, 0]
-        buffer[0] = self._readRegister(register)
-        buffer[1] = self._readRegister(register + 1)
-        return (buffer[1] << 8) | buffer[0]
+        # The address pointer toggles between the A/B register pair
+        # (IOCON.BANK = 0), so both bytes are read in a single transfer.
+        buf = self._tx4_read
+        buf[1] = register
+        data = self._spi.xfer2(buf)
+        return (data[3] << 8) | data[2]
 
     def _writeRegisterWord(self, register, data):
-        assert self.isInitialized
-        self._writeRegister(register, data & 0xFF)
-        self._writeRegister(register + 1, data >> 8)
+        if self._batch_snapshot is not None:
+            return
+        buf = self._tx4_write
+        buf[1] = register
+        buf[2] = data & 0xFF
+        buf[3] = (data >> 8) & 0xFF
+        self._spi_write(buf)
 
     def _setupGPIO(self):
         reset_pin = self.reset_pin
@@ -333,15 +564,17 @@ class MCP23S17(object):
         for channel, pin in zip("AB", self.int_pins):
             if pin is not None:
                 pin.set_input()
-                pin.on_interrupt(self.int_level, lambda: self.on_interrupt(channel))
+                pin.on_interrupt(self.int_level, partial(self.on_interrupt, channel))
 
     def on_interrupt(self, channel: str):
         raise NotImplementedError("This method is abstract")
 
     def _setSpiMode(self, mode):
-        if self._spi.mode != mode:
+        # compare against the last mode set, reading spi.mode is an ioctl
+        if self._current_mode != mode:
             self._spi.mode = mode
             self._spi.xfer2([0])  # dummy write, to force CLK to correct level
+            self._current_mode = mode
 
     def __getitem__(self, item):
         return VirtualPin(self, item)
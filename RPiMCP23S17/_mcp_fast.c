@@ -0,0 +1,173 @@
+/*
+ * Copyright 2016-2019 Florian Mueller (contact@petrockblock.com)
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining
+ * a copy of this software and associated documentation files (the
+ * "Software"), to deal in the Software without restriction, including
+ * without limitation the rights to use, copy, modify, merge, publish,
+ * distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so, subject to
+ * the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+ * MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+ * LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+ * WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+/*
+ * Optional fast path for MCP23S17.digitalWrite. The transfer is issued
+ * directly on the spidev file descriptor and the pin's bit is updated in
+ * the Python-side register mirror, so both paths share the same state.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <errno.h>
+#include <string.h>
+#include <sys/ioctl.h>
+#include <linux/spi/spidev.h>
+
+#define MCP23S17_GPIOA 0x12
+#define N_PINS 16
+
+typedef struct {
+    PyObject_HEAD
+    int fd;
+    unsigned char cmd;
+    Py_ssize_t offset;
+    Py_buffer mirror;
+} FastMCP;
+
+static int
+FastMCP_init(FastMCP *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"fd", "cmd", "mirror", "offset", NULL};
+    int fd;
+    unsigned char cmd;
+    PyObject *mirror;
+    Py_ssize_t offset = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "ibO|n", kwlist,
+                                     &fd, &cmd, &mirror, &offset))
+        return -1;
+
+    if (self->mirror.obj != NULL)
+        PyBuffer_Release(&self->mirror);
+    if (PyObject_GetBuffer(mirror, &self->mirror, PyBUF_WRITABLE) < 0)
+        return -1;
+    if (offset < 0 || offset + 2 > self->mirror.len) {
+        PyBuffer_Release(&self->mirror);
+        PyErr_SetString(PyExc_ValueError, "mirror too small for offset");
+        return -1;
+    }
+
+    self->fd = fd;
+    self->cmd = cmd;
+    self->offset = offset;
+    return 0;
+}
+
+static void
+FastMCP_dealloc(FastMCP *self)
+{
+    if (self->mirror.obj != NULL)
+        PyBuffer_Release(&self->mirror);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+FastMCP_digital_write(FastMCP *self, PyObject *args)
+{
+    int pin, level, ret;
+    unsigned char *mirror, data, mask, buf[3];
+    struct spi_ioc_transfer xfer;
+
+    if (!PyArg_ParseTuple(args, "ii", &pin, &level))
+        return NULL;
+    if (self->mirror.obj == NULL) {
+        PyErr_SetString(PyExc_ValueError, "FastMCP not initialized");
+        return NULL;
+    }
+    if (pin < 0 || pin >= N_PINS) {
+        PyErr_SetString(PyExc_IndexError, "pin index out of range");
+        return NULL;
+    }
+
+    mirror = (unsigned char *)self->mirror.buf + self->offset + (pin >> 3);
+    mask = (unsigned char)(1 << (pin & 0x07));
+    data = (level == 1) ? (*mirror | mask) : (*mirror & ~mask);
+
+    buf[0] = self->cmd;
+    buf[1] = (unsigned char)(MCP23S17_GPIOA + (pin >> 3));
+    buf[2] = data;
+
+    /* speed_hz and bits_per_word left at 0 use the device defaults */
+    memset(&xfer, 0, sizeof(xfer));
+    xfer.tx_buf = (unsigned long)buf;
+    xfer.len = sizeof(buf);
+
+    Py_BEGIN_ALLOW_THREADS
+    ret = ioctl(self->fd, SPI_IOC_MESSAGE(1), &xfer);
+    Py_END_ALLOW_THREADS
+    if (ret < 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+
+    *mirror = data;
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef FastMCP_methods[] = {
+    {"digital_write", (PyCFunction)FastMCP_digital_write, METH_VARARGS,
+     "digital_write(pin, level)\n\n"
+     "Sets the level of a given pin and updates the register mirror."},
+    {NULL}
+};
+
+static PyTypeObject FastMCPType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "RPiMCP23S17._mcp_fast.FastMCP",
+    .tp_doc = "FastMCP(fd, cmd, mirror, offset=0)\n\n"
+              "Writes GPIO pins of a MCP23S17 directly through a spidev file descriptor.",
+    .tp_basicsize = sizeof(FastMCP),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc)FastMCP_init,
+    .tp_dealloc = (destructor)FastMCP_dealloc,
+    .tp_methods = FastMCP_methods,
+};
+
+static struct PyModuleDef mcp_fast_module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "_mcp_fast",
+    .m_doc = "C fast path for RPiMCP23S17.",
+    .m_size = -1,
+};
+
+PyMODINIT_FUNC
+PyInit__mcp_fast(void)
+{
+    PyObject *m;
+
+    if (PyType_Ready(&FastMCPType) < 0)
+        return NULL;
+
+    m = PyModule_Create(&mcp_fast_module);
+    if (m == NULL)
+        return NULL;
+
+    Py_INCREF(&FastMCPType);
+    if (PyModule_AddObject(m, "FastMCP", (PyObject *)&FastMCPType) < 0) {
+        Py_DECREF(&FastMCPType);
+        Py_DECREF(m);
+        return NULL;
+    }
+    return m;
+}
@@ -9,6 +9,8 @@ class VirtualPin(GenericPin):
     def __init__(self, mcp, pin_id: int):
         super(VirtualPin, self).__init__(pin_id)
         self.mcp = mcp
+        self._write = mcp.digitalWrite
+        self._read = mcp.digitalRead
         self._callback = None
 
     def setup(self, mode, *args, **kwargs):
@@ -17,12 +19,18 @@ class VirtualPin(GenericPin):
     @property
     @assert_input
     def value(self) -> bool:
-        return self.mcp.digitalRead(self.pin_id)
+        return self._read(self.pin_id)
 
     @value.setter
     @assert_output
     def value(self, value: bool):
-        self.mcp.digitalWrite(value)
+        self._write(self.pin_id, value)
+
+    def write_fast(self, value: bool):
+        """Sets the pin level without checking the pin is an output.
+        Intended for tight loops on a pin already set up as output.
+        """
+        self._write(self.pin_id, value)
 
     @assert_input
     def on_interrupt(self, event, callback, **kwargs):
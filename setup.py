@@ -47,4 +47,8 @@ setuptools.setup(
       classifiers      = classifiers,
       install_requires = ['RPi.GPIO',
                           'spidev'],
-      packages         = ['RPiMCP23S17'])
+      packages         = ['RPiMCP23S17'],
+      # optional C fast path, the pure Python code is used if it fails to build
+      ext_modules      = [setuptools.Extension('RPiMCP23S17._mcp_fast',
+                                               ['RPiMCP23S17/_mcp_fast.c'],
+                                               optional=True)])